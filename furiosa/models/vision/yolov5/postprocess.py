@@ -1,21 +1,14 @@
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, Sequence
 
+from numba import njit
 import numpy as np
-import torch
-import torchvision
 
 from ...types import PythonPostProcessor
 from ..postprocess import LtrbBoundingBox, ObjectDetectionResult
 
-
-def _reshape_output(feat: np.ndarray, anchor_per_layer_count: int, num_classes: int):
-    return feat.reshape(
-        feat.shape[0],  # batch
-        anchor_per_layer_count,
-        num_classes + 5,  # boundingbox(4) + objectness score + classes score of that object
-        feat.shape[2],  # the number of width grid
-        feat.shape[3],  # the number of height grid
-    ).transpose(0, 1, 3, 4, 2)
+# Shared by all postprocessors to decode the P3, P4 and P5 layers concurrently
+_DECODE_POOL = ThreadPoolExecutor(max_workers=3, thread_name_prefix="yolov5-decode")
 
 
 class YOLOv5PythonPostProcessor(PythonPostProcessor):
@@ -30,6 +23,14 @@ class YOLOv5PythonPostProcessor(PythonPostProcessor):
             dtype=np.float32,
         )
         self.grid, self.anchor_grid = self.init_grid()
+        # Grid shape (height, width) and prediction rows of each layer, fixed by the input shape
+        self.grid_shapes = [grid.shape[3:] for grid in self.grid]
+        self.layer_rows = []
+        row = 0
+        for height, width in self.grid_shapes:
+            self.layer_rows.append(slice(row, row + self.anchor_per_layer_count * height * width))
+            row = self.layer_rows[-1].stop
+        self.num_rows = row
 
     def __call__(
         self,
@@ -66,32 +67,24 @@ class YOLOv5PythonPostProcessor(PythonPostProcessor):
                 options:
                     show_source: true
         """
-        outputs = []
-        model_outputs = [
-            _reshape_output(f, self.anchor_per_layer_count, len(self.class_names))
-            for f in model_outputs
-        ]
-        for model_output, grid, stride, anchor_grid in zip(
-            model_outputs, self.grid, self.stride, self.anchor_grid
-        ):
-            _, _, nx, ny, _ = model_output.shape
-            if with_sigmoid:
-                model_output = sigmoid(model_output)
-            xy, wh, conf = np.split(model_output, [2, 4], axis=4)
-            xy = (xy * 2 + grid) * stride
-            wh = (wh * 2) ** 2 * anchor_grid
-            y = np.concatenate((xy, wh, conf), axis=4)
-            outputs.append(
-                np.reshape(
-                    y,
-                    (
-                        1,
-                        self.anchor_per_layer_count * nx * ny,
-                        len(self.class_names) + 5,
-                    ),
-                )
+        # Every layer fills its own rows of the decode buffer, which would be left uninitialized
+        if len(model_outputs) != self.num_layers:
+            raise ValueError(
+                f"expected {self.num_layers} model outputs, one per layer, "
+                f"but got {len(model_outputs)}"
             )
-        outputs = np.concatenate(outputs, axis=1)
+        batch_size = model_outputs[0].shape[0]
+        num_outputs = len(self.class_names) + 5
+        outputs = np.empty((batch_size, self.num_rows, num_outputs), dtype=model_outputs[0].dtype)
+        # The layers fill disjoint rows of `outputs`, and NumPy releases the GIL while computing
+        # on arrays, so that the layers can be decoded concurrently
+        list(
+            _DECODE_POOL.map(
+                lambda model_output, i: self._decode_layer(outputs, model_output, i, with_sigmoid),
+                model_outputs,
+                range(self.num_layers),
+            )
+        )
         model_outputs = non_max_suppression(outputs, conf_thres, iou_thres)
 
         batched_detected_boxes = []
@@ -121,6 +114,32 @@ class YOLOv5PythonPostProcessor(PythonPostProcessor):
 
         return batched_detected_boxes
 
+    def _decode_layer(
+        self, outputs: np.ndarray, model_output: np.ndarray, i: int, with_sigmoid: bool
+    ) -> None:
+        """Decode the output of the i-th layer into its rows of `outputs`."""
+        batch_size, _, num_outputs = outputs.shape
+        grid_shape = self.grid_shapes[i]
+        # Decode on the channel-first layout of the model output, where each channel is
+        # contiguous, and write the results straight into the rows of this layer
+        model_output = model_output.reshape(
+            batch_size, self.anchor_per_layer_count, num_outputs, *grid_shape
+        )
+        y = (
+            outputs[:, self.layer_rows[i]]
+            .reshape(batch_size, self.anchor_per_layer_count, *grid_shape, num_outputs)
+            .transpose(0, 1, 4, 2, 3)
+        )
+        xy, wh, conf = np.split(model_output, [2, 4], axis=2)
+        if with_sigmoid:
+            # Per slice, without materializing the sigmoid of the whole model output
+            xy, wh = sigmoid(xy), sigmoid(wh)
+            y[:, :, 4:] = sigmoid(conf)
+        else:
+            y[:, :, 4:] = conf
+        y[:, :, 0:2] = (xy * 2 + self.grid[i]) * self.stride[i]
+        y[:, :, 2:4] = (wh * 2) ** 2 * self.anchor_grid[i]
+
     def init_grid(self):
         grid = [np.zeros(1)] * self.num_layers
         anchor_grid = [np.zeros(1)] * self.num_layers
@@ -138,23 +157,25 @@ class YOLOv5PythonPostProcessor(PythonPostProcessor):
         return grid, anchor_grid
 
     def make_grid(self, nx: int, ny: int, i: int):
-        shape = 1, self.anchor_per_layer_count, ny, nx, 2
-        y, x = np.arange(ny, dtype=np.float32), np.arange(nx, dtype=np.float32)
-        yv, xv = np.meshgrid(y, x, indexing="ij")
-        grid = np.broadcast_to(np.stack((xv, yv), axis=2), shape) - 0.5
-        anchor_grid = np.broadcast_to(
-            np.reshape(
-                self.anchors[i] * self.stride[i],
-                (1, self.anchor_per_layer_count, 1, 1, 2),
-            ),
-            shape,
+        # Laid out like the channel-first model outputs, (x, y) next to the anchor axis, and
+        # broadcast by the decode over the axes they don't vary along
+        grid = np.empty((1, 1, 2, ny, nx), dtype=np.float32)
+        grid[0, 0, 0] = np.arange(nx, dtype=np.float32) - 0.5
+        grid[0, 0, 1] = np.arange(ny, dtype=np.float32)[:, None] - 0.5
+        anchor_grid = np.reshape(
+            self.anchors[i] * self.stride[i],
+            (1, self.anchor_per_layer_count, 2, 1, 1),
         )
         return grid, anchor_grid
 
 
 def sigmoid(x: np.ndarray) -> np.ndarray:
     # pylint: disable=invalid-name
-    return 1 / (1 + np.exp(-x))
+    # 1 / (1 + exp(-x)), computed in the single buffer allocated by the negation
+    out = np.negative(x)
+    np.exp(out, out=out)
+    out += 1
+    return np.divide(1, out, out=out)
 
 
 # https://github.com/ultralytics/yolov5/blob/v7.0/utils/general.py#L884-L999
@@ -167,7 +188,6 @@ def non_max_suppression(
     # pylint: disable=invalid-name,too-many-locals
 
     batch_size = prediction.shape[0]
-    candidates = prediction[..., 4] > conf_thres
     assert 0 <= conf_thres <= 1, conf_thres
     assert 0 <= iou_thres <= 1, iou_thres
 
@@ -176,45 +196,148 @@ def non_max_suppression(
     max_det: int = 300
 
     output = [np.empty((0, 6))] * batch_size
-    for xi, x in enumerate(prediction):
-        x = x[candidates[xi]]
-        if not x.shape[0]:
-            continue
+    # Gather the (box, conf, class) candidates of all images at once, keeping the image index of
+    # each; the threshold is compared in the precision of the predictions, as NumPy does. Each of
+    # (x1, y1, x2, y2, conf, class) is a contiguous row of x, so that NMS reads them sequentially.
+    x, image_index = _select_candidates(
+        np.ascontiguousarray(prediction), prediction.dtype.type(conf_thres)
+    )
+
+    # Check shape
+    if not x.shape[1]:  # no boxes
+        return output
+    num_boxes = np.bincount(image_index, minlength=batch_size)  # number of boxes per image
+    if (num_boxes > max_nms).any():
+        # remove excess boxes, _nms sorts the rest by confidence by itself
+        excess = np.zeros(x.shape[1], dtype=np.bool_)
+        for xi in np.flatnonzero(num_boxes > max_nms):
+            columns = np.flatnonzero(image_index == xi)
+            excess[columns[np.argpartition(-x[4, columns], max_nms - 1)[max_nms:]]] = True
+        # compress keeps the rows of x contiguous, where x[:, ~excess] would not
+        x, image_index = np.compress(~excess, x, axis=1), image_index[~excess]
+
+    # NMS for all images at once, where boxes only suppress boxes of the same group, i.e., the same
+    # image and class. The class offset is not needed to separate classes anymore, but keeps the
+    # IoUs rounded as they were.
+    classes = x[5] * (0 if agnostic else max_wh)  # classes
+    boxes, scores = x[:4] + classes, x[4]  # boxes (offset by class), scores
+    groups = image_index
+    if not agnostic:
+        groups = image_index * (prediction.shape[2] - 5) + x[5].astype(np.int64)
+
+    i = _nms(*boxes, scores, groups, iou_thres)
+
+    kept_image_index = image_index[i]
+    for xi in range(batch_size):
+        kept = i[kept_image_index == xi]
+        # sort by confidence, breaking ties by candidate index as a single NMS over the image would
+        kept = kept[np.lexsort((kept, -scores[kept]))]
+        output[xi] = x.T[kept[:max_det]]  # limit detections, as (x1, y1, x2, y2, conf, class) rows
 
-        # Compute conf
-        x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+    return output
 
-        # Box/Mask
-        box = xywh2xyxy(x[:, :4])  # center_x, center_y, width, height) to (x1, y1, x2, y2)
 
-        i, j = np.where(x[:, 5:] > conf_thres)
-        x = np.concatenate(
-            (
-                box[i],
-                x[i, j + 5, np.newaxis].astype(np.float32),
-                j[:, np.newaxis].astype(np.float32),
-            ),
-            axis=1,
-        )
-
-        # Check shape
-        n = x.shape[0]  # number of boxes
-        if not n:  # no boxes
+@njit(cache=True, nogil=True, error_model="numpy")
+def _select_candidates(prediction: np.ndarray, conf_thres: float):
+    """Gather the candidates of (center x, center y, width, height, obj_conf, cls_conf...) rows.
+
+    Each row whose objectness is above `conf_thres` yields an (x1, y1, x2, y2, conf, class)
+    candidate for every class whose conf = obj_conf * cls_conf is above `conf_thres` as well, in a
+    single pass over the predictions instead of one per step.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: the candidates, as a (6, n) array with one row per field,
+            and the index of the image of each.
+    """
+    batch_size, num_rows, num_outputs = prediction.shape
+    num_candidates = 0
+    for b in range(batch_size):
+        for r in range(num_rows):
+            obj_conf = prediction[b, r, 4]
+            if obj_conf > conf_thres:
+                for c in range(5, num_outputs):
+                    if prediction[b, r, c] * obj_conf > conf_thres:
+                        num_candidates += 1
+
+    candidates = np.empty((6, num_candidates), dtype=prediction.dtype)
+    image_index = np.empty(num_candidates, dtype=np.int64)
+    k = 0
+    for b in range(batch_size):
+        for r in range(num_rows):
+            obj_conf = prediction[b, r, 4]
+            if obj_conf <= conf_thres:
+                continue
+            center_x, center_y = prediction[b, r, 0], prediction[b, r, 1]
+            half_w, half_h = prediction[b, r, 2] / 2, prediction[b, r, 3] / 2
+            for c in range(5, num_outputs):
+                conf = prediction[b, r, c] * obj_conf
+                if conf > conf_thres:
+                    candidates[0, k] = center_x - half_w
+                    candidates[1, k] = center_y - half_h
+                    candidates[2, k] = center_x + half_w
+                    candidates[3, k] = center_y + half_h
+                    candidates[4, k] = conf
+                    candidates[5, k] = c - 5
+                    image_index[k] = b
+                    k += 1
+    return candidates, image_index
+
+
+@njit(cache=True, nogil=True, error_model="numpy")
+def _nms(
+    x1: np.ndarray,
+    y1: np.ndarray,
+    x2: np.ndarray,
+    y2: np.ndarray,
+    scores: np.ndarray,
+    groups: np.ndarray,
+    iou_threshold: float,
+) -> np.ndarray:
+    """Greedy non-maximum suppression over (x1, y1, x2, y2) boxes, run separately for each group.
+
+    The arithmetic follows the CPU kernel of `torchvision.ops.nms` so that the kept boxes of each
+    group are identical to it. The compiled kernel releases the GIL, so that postprocessors running
+    on other threads are not blocked while it runs.
+
+    Returns:
+        np.ndarray: indices of the kept boxes, sorted by group and then in decreasing order of
+            scores.
+    """
+    n = scores.shape[0]
+    # Sort by group, then by score; ties are broken by index like torchvision does
+    order = np.argsort(-scores, kind="mergesort")
+    order = order[np.argsort(groups[order], kind="mergesort")]
+    # Gather the coordinates in this order so that the inner loop reads them sequentially
+    x1, y1, x2, y2 = x1[order], y1[order], x2[order], y2[order]
+    areas = (x2 - x1) * (y2 - y1)
+    # The end of the group of each box, so that the inner loop reads nothing but the coordinates
+    sorted_groups = groups[order]
+    group_ends = np.empty(n, dtype=np.int64)
+    for i in range(n - 1, -1, -1):
+        if i == n - 1 or sorted_groups[i] != sorted_groups[i + 1]:
+            group_ends[i] = i + 1
+        else:
+            group_ends[i] = group_ends[i + 1]
+    suppressed = np.zeros(n, dtype=np.bool_)
+    keep = np.empty(n, dtype=np.int64)
+    num_kept = 0
+    for i in range(n):
+        if suppressed[i]:
             continue
-        x = x[np.argsort(x[:, 4])[::-1][:max_nms]]  # sort by confidence and remove excess boxes
-
-        # NMS
-        classes = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
-        boxes, scores = x[:, :4] + classes, x[:, 4]  # boxes (offset by class), scores
-
-        i = torchvision.ops.nms(
-            torch.from_numpy(boxes), torch.from_numpy(scores), iou_thres
-        ).numpy()
-        i = i[:max_det]  # limit detections
-
-        output[xi] = x[i]
-
-    return output
+        keep[num_kept] = order[i]
+        num_kept += 1
+        ix1, iy1, ix2, iy2, iarea = x1[i], y1[i], x2[i], y2[i], areas[i]
+        for j in range(i + 1, group_ends[i]):
+            if suppressed[j]:
+                continue
+            w = min(ix2, x2[j]) - max(ix1, x1[j])
+            h = min(iy2, y2[j]) - max(iy1, y1[j])
+            # Disjoint boxes have zero IoU, so the division can be skipped for them
+            if w > 0 and h > 0:
+                inter = w * h
+                if inter / (iarea + areas[j] - inter) > iou_threshold:
+                    suppressed[j] = True
+    return keep[:num_kept]
 
 
 # https://github.com/ultralytics/yolov5/blob/v7.0/utils/general.py#L760-L767
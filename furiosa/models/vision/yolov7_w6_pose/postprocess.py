@@ -59,7 +59,11 @@ def _nms(box_scores: np.ndarray, iou_threshold: float = 0.45) -> np.ndarray:
     output = []
     for box_scores in box_scores:
         scores = box_scores[:, 4]
-        boxes = box_scores[:, :4]
+        x1, y1, x2, y2 = np.ascontiguousarray(box_scores[:, :4].T)
+        areas = _box_area(box_scores[:, :2], box_scores[:, 2:4])
+        # Scratch buffers for the IoU of the current box against the rest, reused every iteration
+        scratch = np.empty((5, len(box_scores)), dtype=box_scores.dtype)
+        survivors = np.empty(len(box_scores), dtype=np.bool_)
         picked = []
         indexes = np.argsort(scores)[::-1]
         while len(indexes) > 0:
@@ -67,11 +71,22 @@ def _nms(box_scores: np.ndarray, iou_threshold: float = 0.45) -> np.ndarray:
             picked.append(current.item())
             if len(indexes) == 1:
                 break
-            current_box = boxes[current, :]
             indexes = indexes[1:]
-            rest_boxes = boxes[indexes, :]
-            iou = _box_iou(rest_boxes, np.expand_dims(current_box, axis=0))
-            indexes = indexes[iou <= iou_threshold]
+            xx1, yy1, xx2, yy2, iou = scratch[:, : len(indexes)]
+            np.maximum(np.take(x1, indexes, out=xx1, mode="clip"), x1[current], out=xx1)
+            np.maximum(np.take(y1, indexes, out=yy1, mode="clip"), y1[current], out=yy1)
+            np.minimum(np.take(x2, indexes, out=xx2, mode="clip"), x2[current], out=xx2)
+            np.minimum(np.take(y2, indexes, out=yy2, mode="clip"), y2[current], out=yy2)
+            width = np.maximum(np.subtract(xx2, xx1, out=xx2), 0.0, out=xx2)
+            height = np.maximum(np.subtract(yy2, yy1, out=yy2), 0.0, out=yy2)
+            overlap_area = np.multiply(width, height, out=width)
+            # iou = overlap_area / (rest_areas + current_area - overlap_area + eps), in place
+            np.take(areas, indexes, out=iou, mode="clip")
+            iou += areas[current]
+            iou -= overlap_area
+            iou += 1e-5
+            np.divide(overlap_area, iou, out=iou)
+            indexes = indexes[np.less_equal(iou, iou_threshold, out=survivors[: len(indexes)])]
         output.append(box_scores[picked, :])
     return output
 
@@ -83,17 +98,6 @@ def _box_area(left_top: np.ndarray, right_bottom: np.ndarray):
     return width_height[..., 0] * width_height[..., 1]
 
 
-def _box_iou(boxes1: np.ndarray, boxes2: np.ndarray, eps: float = 1e-5) -> np.ndarray:
-    """Return intersection-over-union (Jaccard index) of boxes."""
-    # https://github.com/mlcommons/inference/blob/de6497f9d64b85668f2ab9c26c9e3889a7be257b/vision/classification_and_detection/python/models/utils.py#L103-L119
-    overlap_left_top = np.maximum(boxes1[..., :2], boxes2[..., :2])
-    overlap_right_bottom = np.minimum(boxes1[..., 2:], boxes2[..., 2:])
-    overlap_area = _box_area(overlap_left_top, overlap_right_bottom)
-    area1 = _box_area(boxes1[..., :2], boxes1[..., 2:])
-    area2 = _box_area(boxes2[..., :2], boxes2[..., 2:])
-    return overlap_area / (area1 + area2 - overlap_area + eps)
-
-
 class YOLOv7w6PosePostProcessor(PythonPostProcessor):
     def __init__(
         self,
@@ -162,18 +166,17 @@ class YOLOv7w6PosePostProcessor(PythonPostProcessor):
             boxes_kpts_dec = self.pose_decoder(y_dets_kpts)
             boxes_kpts_dec = _nms(boxes_kpts_dec, self.iou_thres)[0]
 
-            # rescale boxes
-            boxes_kpts_dec[:, [0, 2]] = (1 / scale) * (boxes_kpts_dec[:, [0, 2]] - padw)
-            boxes_kpts_dec[:, [1, 3]] = (1 / scale) * (boxes_kpts_dec[:, [1, 3]] - padh)
-
-            boxes_kpts_dec[:, 6 + 0 : 6 + 3 * self.nkpt : 3] = (1 / scale) * (
-                boxes_kpts_dec[:, 6 + 0 : 6 + 3 * self.nkpt : 3] - padw
-            )
-            boxes_kpts_dec[:, 6 + 1 : 6 + 3 * self.nkpt : 3] = (1 / scale) * (
-                boxes_kpts_dec[:, 6 + 1 : 6 + 3 * self.nkpt : 3] - padh
-            )
-
-            # rescale keypoints
+            # rescale boxes and keypoints in place, viewing their coordinates as (x, y) pairs; the
+            # reshapes below are views only if the rows are contiguous, so make sure they are
+            boxes_kpts_dec = np.ascontiguousarray(boxes_kpts_dec)
+            pad = np.array([padw, padh], dtype=boxes_kpts_dec.dtype)
+            inv_scale = boxes_kpts_dec.dtype.type(1 / scale)
+            for points in (
+                boxes_kpts_dec[:, 0:4].reshape(-1, 2, 2),
+                boxes_kpts_dec[:, 6 : 6 + 3 * self.nkpt].reshape(-1, self.nkpt, 3)[..., 0:2],
+            ):
+                points -= pad
+                points *= inv_scale
 
             boxes_batched.append(boxes_kpts_dec)
 
@@ -0,0 +1,165 @@
+import copy
+import pickle
+
+import numpy as np
+import pytest
+import torch
+import torchvision
+
+from furiosa.models.vision.yolov5 import postprocess
+from furiosa.models.vision.yolov5.postprocess import (
+    YOLOv5PythonPostProcessor,
+    _nms,
+    _select_candidates,
+    non_max_suppression,
+    xywh2xyxy,
+)
+
+NUM_CLASSES = 10
+INPUT_SHAPE = (256, 256)
+
+
+def random_boxes(num_boxes: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    left_top = rng.uniform(0, 600, size=(num_boxes, 2))
+    width_height = rng.uniform(1, 120, size=(num_boxes, 2))
+    boxes = np.concatenate((left_top, left_top + width_height), axis=1).astype(np.float32)
+    scores = rng.uniform(0, 1, size=num_boxes).astype(np.float32)
+    return boxes, scores
+
+
+def test_nms_matches_torchvision():
+    boxes, scores = random_boxes(5000)
+    groups = np.zeros(len(boxes), dtype=np.int64)
+    for iou_thres in (0.3, 0.45, 0.7):
+        expected = torchvision.ops.nms(
+            torch.from_numpy(boxes), torch.from_numpy(scores), iou_thres
+        ).numpy()
+        np.testing.assert_array_equal(_nms(*boxes.T, scores, groups, iou_thres), expected)
+
+
+def test_nms_groups_match_torchvision_batched_nms():
+    boxes, scores = random_boxes(5000)
+    groups = np.random.default_rng(0).integers(0, 20, size=len(boxes))
+    expected = torchvision.ops.batched_nms(
+        torch.from_numpy(boxes), torch.from_numpy(scores), torch.from_numpy(groups), 0.45
+    ).numpy()
+    kept = _nms(*boxes.T, scores, groups, 0.45)
+    np.testing.assert_array_equal(np.sort(kept), np.sort(expected))
+    assert np.all(np.diff(groups[kept]) >= 0), "kept boxes must be ordered by group"
+
+
+def test_nms_empty():
+    boxes, scores = random_boxes(0)
+    assert _nms(*boxes.T, scores, np.zeros(0, dtype=np.int64), 0.45).shape == (0,)
+
+
+def test_select_candidates_matches_numpy():
+    rng = np.random.default_rng(0)
+    prediction = rng.uniform(0, 1, size=(2, 1000, 15)).astype(np.float32)
+    prediction[..., :4] *= 640
+    conf_thres = np.float32(0.3)
+    candidates, image_index = _select_candidates(prediction, conf_thres)
+
+    expected, expected_image_index = [], []
+    for xi, x in enumerate(prediction):
+        x = x[x[:, 4] > conf_thres]
+        x[:, 5:] *= x[:, 4:5]
+        i, j = (x[:, 5:] > conf_thres).nonzero()
+        expected.append(np.concatenate((xywh2xyxy(x[i, :4]), x[i, j + 5, None], j[:, None]), 1))
+        expected_image_index.append(np.full(len(i), xi))
+    np.testing.assert_array_equal(candidates.T, np.concatenate(expected))
+    np.testing.assert_array_equal(image_index, np.concatenate(expected_image_index))
+
+
+def random_model_outputs(batch_size: int, with_sigmoid: bool, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    model_outputs = []
+    for i in range(3):
+        ny, nx = (size // (8 * 2**i) for size in INPUT_SHAPE)
+        logits = rng.normal(-4, 2.5, size=(batch_size, 3 * (NUM_CLASSES + 5), ny, nx))
+        logits = logits.astype(np.float32)
+        model_outputs.append(logits if with_sigmoid else 1 / (1 + np.exp(-logits)))
+    return model_outputs
+
+
+def make_postprocessor():
+    anchors = np.random.default_rng(0).uniform(4, 64, size=(3, 3, 2)).astype(np.float32)
+    return YOLOv5PythonPostProcessor(anchors, [str(c) for c in range(NUM_CLASSES)], INPUT_SHAPE)
+
+
+def reference_decode(processor, model_outputs, with_sigmoid):
+    """Decode each layer in the channel-last layout and concatenate them, as YOLOv5 does."""
+    outputs = []
+    for i, model_output in enumerate(model_outputs):
+        batch_size, _, ny, nx = model_output.shape
+        model_output = model_output.reshape(batch_size, 3, NUM_CLASSES + 5, ny, nx)
+        model_output = model_output.transpose(0, 1, 3, 4, 2)
+        if with_sigmoid:
+            model_output = 1 / (1 + np.exp(-model_output))
+        yv, xv = np.meshgrid(np.arange(ny), np.arange(nx), indexing="ij")
+        grid = np.stack((xv, yv), axis=2).reshape(1, 1, ny, nx, 2).astype(np.float32) - 0.5
+        anchor_grid = (processor.anchors[i] * processor.stride[i]).reshape(1, 3, 1, 1, 2)
+        xy, wh, conf = np.split(model_output, [2, 4], axis=4)
+        xy = (xy * 2 + grid) * processor.stride[i]
+        wh = (wh * 2) ** 2 * anchor_grid
+        y = np.concatenate((xy, wh, conf), axis=4)
+        outputs.append(y.reshape(batch_size, -1, NUM_CLASSES + 5))
+    return np.concatenate(outputs, axis=1)
+
+
+@pytest.mark.parametrize("batch_size", [1, 2])
+@pytest.mark.parametrize("with_sigmoid", [False, True])
+@pytest.mark.parametrize("conf_thres", [0.001, 0.25, 0.5])
+def test_decode_matches_reference(monkeypatch, batch_size, with_sigmoid, conf_thres):
+    processor = make_postprocessor()
+    model_outputs = random_model_outputs(batch_size, with_sigmoid)
+    contexts = [{"scale": 0.5, "pad": (0.0, 16.0)}] * batch_size
+
+    predictions = []
+    original_non_max_suppression = postprocess.non_max_suppression
+
+    def non_max_suppression(prediction, *args, **kwargs):
+        predictions.append(prediction.copy())
+        return original_non_max_suppression(prediction, *args, **kwargs)
+
+    monkeypatch.setattr(postprocess, "non_max_suppression", non_max_suppression)
+    detected_boxes = processor(model_outputs, contexts, conf_thres, 0.45, with_sigmoid)
+    (prediction,) = predictions
+    np.testing.assert_array_equal(
+        prediction, reference_decode(processor, model_outputs, with_sigmoid)
+    )
+
+    # Each image of the batch is decoded and suppressed as if it were alone
+    assert len(detected_boxes) == batch_size
+    for xi in range(batch_size):
+        single = processor(
+            [o[xi : xi + 1] for o in model_outputs], contexts[:1], conf_thres, 0.45, with_sigmoid
+        )
+        assert detected_boxes[xi] == single[0]
+
+
+def test_postprocessor_copy_and_pickle():
+    processor = make_postprocessor()
+    model_outputs = random_model_outputs(2, False)
+    contexts = [{"scale": 0.5, "pad": (0.0, 16.0)}] * 2
+    expected = processor(model_outputs, contexts)
+    for clone in (copy.deepcopy(processor), pickle.loads(pickle.dumps(processor))):
+        assert clone(model_outputs, contexts) == expected
+
+
+def test_missing_model_outputs():
+    processor = make_postprocessor()
+    contexts = [{"scale": 0.5, "pad": (0.0, 16.0)}]
+    with pytest.raises(ValueError, match="expected 3 model outputs"):
+        processor(random_model_outputs(1, False)[:2], contexts)
+
+
+def test_nms_orders_ties_by_candidate_index():
+    # Two disjoint boxes of the same confidence, the first one of class 1 and the second of class 0
+    prediction = np.zeros((1, 2, 7), dtype=np.float32)
+    prediction[0, :, :4] = [[100, 100, 10, 10], [300, 300, 10, 10]]
+    prediction[0, :, 4] = 1
+    prediction[0, 0, 6] = prediction[0, 1, 5] = 0.5
+    (detections,) = non_max_suppression(prediction, 0.25, 0.45)
+    np.testing.assert_array_equal(detections[:, 5], [1, 0])